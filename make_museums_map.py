@@ -1,66 +1,193 @@
-import json
+import atexit
 import os
 import time
 import html
+import re
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import requests
-import folium
-from folium.plugins import MarkerCluster
+from jinja2 import Template
 
 # -----------------------------
 # Config
 # -----------------------------
 INPUT_JSON = "museums.json"
 CACHE_JSON = "geocode_cache.json"
+CACHE_NDJSON = "geocode_cache.ndjson"  # append-only journal of new lookups
 OUTPUT_HTML = "museums_map.html"
 
 MAP_CENTER = (52.2, 5.3)
 ZOOM_START = 7
-TILE_STYLE = "CartoDB dark_matter"
+TILE_URL = "https://{s}.basemaps.cartocdn.com/dark_all/{z}/{x}/{y}{r}.png"
+TILE_ATTRIBUTION = (
+    '&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors '
+    '&copy; <a href="https://carto.com/attributions">CARTO</a>'
+)
 
 USER_AGENT = "museum-map-scraper/1.0 (contact: youremail@example.com)"
-GEOCODE_SLEEP_SECONDS = 1.2
+
+# Geocoder backend: "nominatim" (public, rate limited), "self_hosted"
+# (own Nominatim instance, no rate limit) or "offline" (GeoNames postcodes).
+GEOCODER_BACKENDS = ("nominatim", "self_hosted", "offline")
+GEOCODER_BACKEND = os.environ.get("GEOCODER_BACKEND", "nominatim")
+if GEOCODER_BACKEND not in GEOCODER_BACKENDS:
+    raise ValueError(f"GEOCODER_BACKEND must be one of {GEOCODER_BACKENDS}, got {GEOCODER_BACKEND!r}")
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+SELF_HOSTED_NOMINATIM_URL = "http://localhost:8080/search"
+GEONAMES_URL = "https://download.geonames.org/export/zip/NL_full.csv.zip"
+GEONAMES_ZIP = "NL_full.csv.zip"
+
+GEOCODE_SLEEP_SECONDS = 1.2 if GEOCODER_BACKEND == "nominatim" else 0
+GEOCODE_WORKERS = 4  # request starts are still paced by GEOCODE_SLEEP_SECONDS
 RETRY_BACKOFF_SECONDS = 5
+NEGATIVE_CACHE_TTL_SECONDS = 30 * 24 * 3600  # retry failed lookups after 30 days
+FORCE_REGEOCODE = os.environ.get("FORCE_REGEOCODE", "") not in ("", "0")  # retry all cached failures
+SAVE_EVERY = 25  # write museums.json after this many newly geocoded items
 
 # -----------------------------
 # Helpers
 # -----------------------------
 def load_json(path, default):
     if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
+        with open(path, "rb") as f:
             try:
-                return json.load(f)
-            except json.JSONDecodeError:
+                return orjson.loads(f.read())
+            except orjson.JSONDecodeError:
                 return default
     return default
 
 
 def save_json(path, obj):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False, indent=2)
+    # Write to a temp file and swap it in, so an interrupted save never
+    # leaves a truncated file behind.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    os.replace(tmp_path, path)
+
+
+def load_geocode_cache():
+    """Load the JSON cache, then replay entries journaled by an interrupted run."""
+    cache = load_json(CACHE_JSON, {})
+    if os.path.exists(CACHE_NDJSON):
+        with open(CACHE_NDJSON, "rb") as f:
+            for line in f:
+                try:
+                    cache.update(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    continue  # torn last line from a crash
+    # Older caches stored bare [lat, lon] pairs under raw addresses; upgrade
+    # them to fresh entries under normalized keys, preferring a hit on collision.
+    now = time.time()
+    normalized = {}
+    for address, entry in cache.items():
+        if not isinstance(entry, dict):
+            entry = {"coords": entry, "ts": now, "tries": 0}
+        key = _normalize_address(address)
+        if key not in normalized or normalized[key]["coords"][0] is None:
+            normalized[key] = entry
+    return normalized
+
+
+def flush_geocode_cache(cache):
+    """Write the full cache once and drop the journal it now contains."""
+    save_json(CACHE_JSON, cache)
+    if os.path.exists(CACHE_NDJSON):
+        os.remove(CACHE_NDJSON)
+
+
+class RateLimiter:
+    """Space calls at least `interval` seconds apart across threads."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+    def defer(self, seconds):
+        """Hold back every caller's next call for at least `seconds`."""
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+_nominatim_limiter = RateLimiter(GEOCODE_SLEEP_SECONDS)
+_journal_lock = threading.Lock()
+
+
+def _journal_cache_entry(address, entry):
+    with _journal_lock, open(CACHE_NDJSON, "ab") as f:
+        f.write(orjson.dumps({address: entry}) + b"\n")
+
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_POSTCODE_SPACE_RE = re.compile(r"\b(\d{4}) ([a-z]{2})\b")
+
+
+def _normalize_address(address):
+    """Cache key for an address: lowercase, no commas, single spaces, '1071dj'."""
+    key = _WHITESPACE_RE.sub(" ", address.replace(",", " ").strip().lower())
+    return _POSTCODE_SPACE_RE.sub(r"\1\2", key)
 
 
 def geocode_address(address, session, cache):
+    """Return (lat, lon) for an address, consulting the cache first.
+
+    Cache entries look like {"coords": [lat, lon], "ts": ..., "tries": n}.
+    Failed lookups are cached as [None, None] and only retried once they are
+    older than NEGATIVE_CACHE_TTL_SECONDS; FORCE_REGEOCODE retries them right
+    away. Cached coordinates are always reused.
+    """
     if not address:
         return (None, None)
-    if address in cache:
-        return cache[address]
-    coords = _geocode_nominatim(address, session)
+    key = _normalize_address(address)
+    entry = cache.get(key)
+    if entry:
+        lat, lon = entry["coords"]
+        if lat is not None and lon is not None:
+            return (lat, lon)
+        if not FORCE_REGEOCODE and time.time() - entry["ts"] < NEGATIVE_CACHE_TTL_SECONDS:
+            return (None, None)
+    tries = entry["tries"] if entry else 0
+
+    coords = _geocode(address, session)
+    tries += 1
     if coords == (None, None):
-        coords = _geocode_nominatim(f"{address}, Netherlands", session)
-    cache[address] = coords
-    save_json(CACHE_JSON, cache)
-    time.sleep(GEOCODE_SLEEP_SECONDS)
-    return coords
+        coords = _geocode(f"{address}, Netherlands", session)
+        tries += 1
+    entry = {"coords": list(coords), "ts": time.time(), "tries": tries}
+    cache[key] = entry
+    _journal_cache_entry(key, entry)
+    return tuple(coords)
+
+
+def _geocode(query, session):
+    if GEOCODER_BACKEND == "offline":
+        return _geocode_offline(query, session)
+    if GEOCODER_BACKEND == "self_hosted":
+        return _geocode_nominatim(query, session, SELF_HOSTED_NOMINATIM_URL)
+    return _geocode_nominatim(query, session, NOMINATIM_URL)
 
 
-def _geocode_nominatim(query, session):
-    url = "https://nominatim.openstreetmap.org/search"
+def _geocode_nominatim(query, session, url):
     params = {"q": query, "format": "json", "limit": 1}
     headers = {"User-Agent": USER_AGENT}
     try:
+        _nominatim_limiter.wait()
         resp = session.get(url, params=params, headers=headers, timeout=20)
         if resp.status_code == 429:
-            time.sleep(RETRY_BACKOFF_SECONDS)
+            # Back off globally, not just in this worker thread
+            _nominatim_limiter.defer(RETRY_BACKOFF_SECONDS)
+            _nominatim_limiter.wait()
             resp = session.get(url, params=params, headers=headers, timeout=20)
         resp.raise_for_status()
         data = resp.json()
@@ -73,30 +200,201 @@ def _geocode_nominatim(query, session):
         return (None, None)
 
 
-def build_popup_html(item, index):
+_POSTCODE_RE = re.compile(r"\b(\d{4})\s?([A-Za-z]{2})\b")
+_offline_index = None
+_offline_lock = threading.Lock()
+
+
+def _load_offline_index(session):
+    """Index GeoNames NL postcodes and place names as {key: (lat, lon)}."""
+    with _offline_lock:
+        if _offline_index is None:
+            _build_offline_index(session)
+    return _offline_index
+
+
+def _build_offline_index(session):
+    global _offline_index
+    if not os.path.exists(GEONAMES_ZIP):
+        resp = session.get(GEONAMES_URL, headers={"User-Agent": USER_AGENT}, timeout=120)
+        resp.raise_for_status()
+        # Same temp-file swap as save_json: never leave a truncated zip behind.
+        tmp_path = f"{GEONAMES_ZIP}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(resp.content)
+        os.replace(tmp_path, GEONAMES_ZIP)
+
+    postcodes, places = {}, {}
+    with zipfile.ZipFile(GEONAMES_ZIP) as zf:
+        name = next(n for n in zf.namelist() if n.endswith(".txt"))
+        with zf.open(name) as f:
+            for raw in f:
+                cols = raw.decode("utf-8").rstrip("\n").split("\t")
+                coords = (float(cols[9]), float(cols[10]))
+                postcode = cols[1].replace(" ", "").upper()
+                postcodes.setdefault(postcode, coords)
+                postcodes.setdefault(postcode[:4], coords)
+                places.setdefault(cols[2].lower(), coords)
+    _offline_index = (postcodes, places)
+
+
+def prepare_offline_backend(session):
+    """Load the offline index up front; return an error message or None.
+
+    Failing here keeps a broken download or missing dependency from being
+    cached as a month of negative lookups.
+    """
+    try:
+        import rapidfuzz  # noqa: F401
+    except ImportError:
+        return "the offline geocoder needs the rapidfuzz package"
+    try:
+        _load_offline_index(session)
+    except requests.RequestException as e:
+        return f"could not download {GEONAMES_URL}: {e}"
+    except (OSError, zipfile.BadZipFile, StopIteration, ValueError, IndexError) as e:
+        if os.path.exists(GEONAMES_ZIP):
+            os.remove(GEONAMES_ZIP)  # re-download on the next run
+        return f"could not read {GEONAMES_ZIP}: {e!r}"
+    return None
+
+
+def _geocode_offline(query, session):
+    from rapidfuzz import fuzz, process
+
+    postcodes, places = _load_offline_index(session)
+    match = _POSTCODE_RE.search(query)
+    if match:
+        digits, letters = match.groups()
+        coords = postcodes.get(digits + letters.upper()) or postcodes.get(digits)
+        if coords:
+            return coords
+    best = process.extractOne(query.lower(), places.keys(),
+                              scorer=fuzz.token_set_ratio, score_cutoff=90)
+    if best is None:
+        return (None, None)
+    return places[best[0]]
+
+
+POPUP_TPL = (
+    '<div id="{museum_id}" class="museum-popup">'
+    '<div class="name">{name}</div>'
+    '<div class="address">{address}</div>'
+    '<div class="link">{link_html}</div>'
+    '{img_html}'
+    '<hr>'
+    '<label><input type="checkbox" class="visited-toggle" data-id="{museum_id}"> Visited</label>'
+    '<textarea class="review-box" data-id="{museum_id}" placeholder="Write a review..."></textarea>'
+    '</div>'
+)
+LINK_TPL = '<a href="{}" target="_blank" rel="noopener">Open pagina</a>'
+IMG_TPL = '<div class="thumb"><img src="{}" alt=""></div>'
+
+# Shared popup styles, emitted once in the page head instead of per marker
+POPUP_CSS = """
+    .museum-popup {font-family: system-ui, -apple-system, Segoe UI, Roboto, sans-serif; max-width: 260px; font-size: 13px;}
+    .museum-popup .name {font-weight: 600; font-size: 14px; margin-bottom: 4px;}
+    .museum-popup .address {color: #333; margin-bottom: 6px;}
+    .museum-popup .thumb {margin-top: 8px;}
+    .museum-popup .thumb img {max-width: 220px; height: auto; border-radius: 8px;}
+    .museum-popup hr {margin: 8px 0;}
+    .museum-popup .review-box {width: 100%; margin-top: 4px; font-size: 13px;}
+"""
+
+
+def build_popup_html(item: dict, index: int) -> str:
     """Build popup with JS controls for 'visited' + review."""
-    name = html.escape(item.get("name", "Unknown"))
-    address = html.escape(item.get("location", "Unknown"))
     link = item.get("link", "")
     thumb = item.get("thumbnail", "")
-    museum_id = f"museum_{index}"
-
-    link_html = f'<a href="{html.escape(link)}" target="_blank" rel="noopener">Open pagina</a>' if link else ""
-    img_html = f'<div style="margin-top:8px;"><img src="{html.escape(thumb)}" alt="" style="max-width:220px;height:auto;border-radius:8px;"></div>' if thumb else ""
-
-    return f"""
-    <div id="{museum_id}" style="font-family: system-ui, -apple-system, Segoe UI, Roboto, sans-serif; max-width: 260px;">
-      <div style="font-weight:600; font-size:14px; margin-bottom:4px;">{name}</div>
-      <div style="font-size:13px; color:#333; margin-bottom:6px;">{address}</div>
-      <div style="font-size:13px;">{link_html}</div>
-      {img_html}
-      <hr style="margin:8px 0;">
-      <label style="font-size:13px;">
-        <input type="checkbox" class="visited-toggle" data-id="{museum_id}"> Visited
-      </label>
-      <textarea class="review-box" data-id="{museum_id}" placeholder="Write a review..." style="width:100%;margin-top:4px;font-size:13px;"></textarea>
-    </div>
+    return POPUP_TPL.format(
+        museum_id=f"museum_{index}",
+        name=html.escape(item.get("name", "Unknown")),
+        address=html.escape(item.get("location", "Unknown")),
+        link_html=LINK_TPL.format(html.escape(link)) if link else "",
+        img_html=IMG_TPL.format(html.escape(thumb)) if thumb else "",
+    )
+
+
+# -----------------------------
+# Map template
+# -----------------------------
+# Markers are shipped as one GeoJSON FeatureCollection and built client-side,
+# so the page size and render time no longer scale with per-marker Python work.
+MAP_TEMPLATE = Template("""<!DOCTYPE html>
+<html>
+<head>
+    <meta http-equiv="content-type" content="text/html; charset=UTF-8" />
+    <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no" />
+    <title>Musea</title>
+    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.css"/>
+    <link rel="stylesheet" href="https://netdna.bootstrapcdn.com/bootstrap/3.0.0/css/bootstrap-glyphicons.css"/>
+    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/Leaflet.awesome-markers/2.0.2/leaflet.awesome-markers.css"/>
+    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/MarkerCluster.css"/>
+    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/MarkerCluster.Default.css"/>
+    <script src="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/Leaflet.awesome-markers/2.0.2/leaflet.awesome-markers.js"></script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/leaflet.markercluster.js"></script>
+    <style>html, body {width: 100%; height: 100%; margin: 0; padding: 0;}</style>
+    <style>#map {position: absolute; top: 0; bottom: 0; right: 0; left: 0;}</style>
+    <style>{{ popup_css }}</style>
+</head>
+<body>
+    <div id="map"></div>
+    <script>
+    const data = {{ geojson }};
+
+    const map = L.map("map", {center: {{ center }}, zoom: {{ zoom }}});
+    L.tileLayer({{ tile_url }}, {
+        maxZoom: 20,
+        subdomains: "abcd",
+        attribution: {{ tile_attribution }}
+    }).addTo(map);
+
+    // start unvisited = red
+    const icon = L.AwesomeMarkers.icon({markerColor: "red", iconColor: "white", icon: "info-sign", prefix: "glyphicon"});
+    const cluster = L.markerClusterGroup();
+    L.geoJSON(data, {
+        pointToLayer: (f, latlng) => L.marker(latlng, {icon: icon}),
+        onEachFeature: (f, l) => {
+            l.bindPopup(f.properties.popup, {maxWidth: 320});
+            l.bindTooltip(f.properties.name);
+        }
+    }).addTo(cluster);
+    cluster.addTo(map);
+    </script>
+    {{ js_code }}
+</body>
+</html>
+""")
+
+
+def _to_js(obj) -> str:
+    """Serialize for inlining in a <script> block."""
+    return orjson.dumps(obj).decode("utf-8").replace("</", "<\\/")
+
+
+def _render_markers(museums: list[dict]) -> str:
+    """Return the GeoJSON FeatureCollection for all geocoded museums as JS.
+
+    This is the per-museum hot loop once geocoding is cached; it is fully
+    annotated so the module can be compiled with mypyc.
     """
+    features: list[dict] = []
+    for i, item in enumerate(museums, start=1):
+        name = item.get("name", "")
+        lat = item.get("latitude")
+        lon = item.get("longitude")
+
+        if lat is None or lon is None:
+            continue
+
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "properties": {"name": name, "popup": build_popup_html(item, i)},
+        })
+        print(f"✅ Added: {name}")
+    return _to_js({"type": "FeatureCollection", "features": features})
 
 
 # -----------------------------
@@ -108,37 +406,43 @@ def main():
         print(f"⚠️ No data found in {INPUT_JSON}.")
         return
     
-    geocode_cache = load_json(CACHE_JSON, {})
+    geocode_cache = load_geocode_cache()
+    atexit.register(flush_geocode_cache, geocode_cache)
     session = requests.Session()
 
-    fmap = folium.Map(location=MAP_CENTER, zoom_start=ZOOM_START, tiles=TILE_STYLE)
-    cluster = MarkerCluster(name="Musea").add_to(fmap)
+    if GEOCODER_BACKEND == "offline":
+        error = prepare_offline_backend(session)
+        if error:
+            print(f"⚠️ Offline geocoder unavailable: {error}")
+            return
 
-    for i, item in enumerate(museums, start=1):
-        name = item.get("name", "")
-        address = item.get("location", "")
-        lat = item.get("latitude")
-        lon = item.get("longitude")
+    # Geocode missing coordinates concurrently; cache hits return immediately
+    # and only real network calls are paced by the rate limiter.
+    pending = [item for item in museums if item.get("latitude") is None or item.get("longitude") is None]
 
-        if lat is None or lon is None:
-            lat, lon = geocode_address(address, session, geocode_cache)
+    def geocode_item(item):
+        return geocode_address(item.get("location", ""), session, geocode_cache)
+
+    dirty = 0
+    pool = ThreadPoolExecutor(max_workers=GEOCODE_WORKERS)
+    try:
+        for item, (lat, lon) in zip(pending, pool.map(geocode_item, pending)):
             item["latitude"] = lat
             item["longitude"] = lon
+            dirty += 1
+            if dirty >= SAVE_EVERY:
+                save_json(INPUT_JSON, museums)
+                dirty = 0
+    except BaseException:
+        # Drop queued lookups (e.g. on Ctrl-C) instead of draining the queue
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    else:
+        pool.shutdown()
+    finally:
+        if dirty:
             save_json(INPUT_JSON, museums)
 
-        if lat is None or lon is None:
-            continue
-
-        popup_html = build_popup_html(item, i)
-        marker = folium.Marker(
-            location=(lat, lon),
-            popup=folium.Popup(popup_html, max_width=320),
-            tooltip=name,
-            icon=folium.Icon(color="red", icon="info-sign")  # start unvisited = red
-        )
-        marker.add_to(cluster)
-        print(f"✅ Added: {name}")
-
     # Inject JavaScript for localStorage visited + review persistence
     js_code = """
     <script>
@@ -180,9 +484,15 @@ def main():
     </script>
     """
 
-    fmap.get_root().html.add_child(folium.Element(js_code))
-
-    fmap.save(OUTPUT_HTML)
+    MAP_TEMPLATE.stream(
+        geojson=_render_markers(museums),
+        center=_to_js(list(MAP_CENTER)),
+        zoom=ZOOM_START,
+        tile_url=_to_js(TILE_URL),
+        tile_attribution=_to_js(TILE_ATTRIBUTION),
+        popup_css=POPUP_CSS,
+        js_code=js_code,
+    ).dump(OUTPUT_HTML, encoding="utf-8")
     print(f"🎉 Map saved to {OUTPUT_HTML}")
 
 if __name__ == "__main__":
@@ -2,110 +2,306 @@ from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
-from selenium.common.exceptions import NoSuchElementException, ElementClickInterceptedException
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import NoSuchElementException, ElementClickInterceptedException, TimeoutException
 from webdriver_manager.chrome import ChromeDriverManager
 import time
-import json
+import itertools
+import orjson
+import asyncio
+import httpx
 import requests
 from bs4 import BeautifulSoup
+import lxml.html
+from lxml.etree import ParserError, strip_elements
 import os
+import sqlite3
+from urllib.parse import urljoin
+import zlib
 
-# --- Selenium setup ---
-options = Options()
-options.add_argument("--headless")          # run browser in background
-options.add_argument("--no-sandbox")
-options.add_argument("--disable-dev-shm-usage")
+USER_AGENT = "museum-map-scraper/1.0 (contact: youremail@example.com)"
+LISTING_URL = "https://www.museum.nl/nl/zien-en-doen/musea"
+MAX_IN_FLIGHT = 8  # concurrent detail-page requests to www.museum.nl
+REQUEST_TIMEOUT_SECONDS = 15
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+CARD_SELECTOR = ".see-and-do-card"
+LOAD_MORE_SELECTOR = ".tiles-block_load-more button.btn-default"
+PAGE_WAIT_SECONDS = 10  # upper bound for cards to appear after load / 'Laad meer'
+LOAD_MORE_RETRIES = 3  # consecutive timed-out clicks before giving up
+PAGE_CACHE_DB = "museum_cache.sqlite"  # zlib-compressed detail pages keyed by URL
+PAGE_CACHE_EXPIRE_SECONDS = 7 * 86400
 
-driver = webdriver.Chrome(
-    service=Service(ChromeDriverManager().install()),
-    options=options
-)
 
-# --- Open page ---
-url = "https://www.museum.nl/nl/zien-en-doen/musea?mv-PageIndex=0"
-driver.get(url)
-time.sleep(3)
+def open_page_cache():
+    conn = sqlite3.connect(PAGE_CACHE_DB)
+    conn.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, fetched REAL, body BLOB)")
+    return conn
 
-print("🌐 Page loaded, starting to click 'Laad meer'...")
 
-# --- Keep clicking "Laad meer" until it's gone ---
-while True:
-    try:
-        load_more = driver.find_element(By.CSS_SELECTOR, ".tiles-block_load-more button.btn-default")
-        driver.execute_script("arguments[0].scrollIntoView(true);", load_more)
-        driver.execute_script("arguments[0].click();", load_more)
-        print("🔄 Loading more museums...")
-        time.sleep(3)
-    except NoSuchElementException:
-        print("✅ No more museums to load.")
-        break
-    except ElementClickInterceptedException:
-        print("⚠️ Could not click 'Laad meer' this round, retrying...")
-        time.sleep(2)
-        continue
+def page_cache_get(conn, url):
+    row = conn.execute("SELECT fetched, body FROM pages WHERE url = ?", (url,)).fetchone()
+    if row is None or time.time() - row[0] > PAGE_CACHE_EXPIRE_SECONDS:
+        return None
+    return zlib.decompress(row[1]).decode("utf-8")
 
-# --- Parse all museum cards ---
-cards = driver.find_elements(By.CSS_SELECTOR, ".see-and-do-card")
 
-museums = []
-output_file = "museums.json"
+def page_cache_put(conn, url, page_html):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)",
+                     (url, time.time(), zlib.compress(page_html.encode("utf-8"))))
 
-# If file exists (resuming), load existing progress
-if os.path.exists(output_file):
-    with open(output_file, "r", encoding="utf-8") as f:
+
+async def fetch_detail(client, link):
+    # Retry connection failures, throttling and server errors with
+    # exponential backoff (0.5, 1, 2 s)
+    for attempt in range(MAX_RETRIES + 1):
         try:
-            museums = json.load(f)
-        except json.JSONDecodeError:
-            museums = []
+            r = await client.get(link)
+        except httpx.TransportError:
+            if attempt == MAX_RETRIES:
+                raise
+        else:
+            if r.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                break
+        await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+    r.raise_for_status()
+    return r.text
+
 
-print(f"🔍 Found {len(cards)} museum cards. Scraping details...")
+ADDRESS_XPATH = "//section[contains(concat(' ', normalize-space(@class), ' '), ' practical-info ')]//address"
 
-for i, card in enumerate(cards, start=1):
+
+def parse_detail(page_html):
     try:
-        # --- Extract link from the card ---
-        link_elem = card.find_element(By.CSS_SELECTOR, "a")
-        partial_link = link_elem.get_attribute("href")
-        link = "https://www.museum.nl" + partial_link if partial_link.startswith("/") else partial_link
-
-        # --- Fetch detail page ---
-        res = requests.get(link)
-        soup = BeautifulSoup(res.text, "html.parser")
-
-        # --- Use <h1> as title ---
-        h1_tag = soup.find("h1")
-        name = h1_tag.get_text(strip=True) if h1_tag else "Unknown"
-
-        # --- Thumbnail from overview card ---
-        img_elem = card.find_element(By.CSS_SELECTOR, "img")
-        thumbnail = img_elem.get_attribute("src") if img_elem else None
-
-        # --- Extract and clean address ---
-        address_tag = soup.select_one("section.practical-info address")
-        if address_tag:
-            for child in address_tag.find_all(["a", "svg", "strong", "span"]):
-                child.decompose()
-            location = address_tag.get_text(separator=" ", strip=True)
-        else:
-            location = "Unknown"
+        try:
+            tree = lxml.html.fromstring(page_html)
+        except ValueError:
+            # str input with an <?xml encoding=...?> declaration must be bytes
+            tree = lxml.html.fromstring(page_html.encode("utf-8"))
+    except ParserError:
+        return "Unknown", "Unknown"
 
-        museum_data = {
+    # --- Use <h1> as title ---
+    h1_tag = tree.find(".//h1")
+    name = " ".join(h1_tag.text_content().split()) if h1_tag is not None else "Unknown"
+
+    # --- Extract and clean address (icons, links and labels dropped in C) ---
+    address_tags = tree.xpath(ADDRESS_XPATH)
+    if address_tags:
+        address_tag = address_tags[0]
+        strip_elements(address_tag, "a", "svg", "strong", "span", with_tail=False)
+        location = " ".join(t.strip() for t in address_tag.itertext() if t.strip())
+    else:
+        location = "Unknown"
+
+    return name, location
+
+
+async def scrape_detail(client, semaphore, cache, i, total, link, thumbnail):
+    try:
+        page_html = page_cache_get(cache, link)
+        cached = page_html is not None
+        if not cached:
+            async with semaphore:
+                page_html = await fetch_detail(client, link)
+        name, location = parse_detail(page_html)
+        # Only keep pages that parsed into something, so a bad response is
+        # refetched on the next run instead of being replayed for 7 days.
+        if not cached and (name, location) != ("Unknown", "Unknown"):
+            page_cache_put(cache, link, page_html)
+        print(f"[{i}/{total}] ✅ {name} — {location}")
+        return {
             "name": name,
             "thumbnail": thumbnail,
             "link": link,
             "location": location
         }
+    except Exception as e:
+        print(f"[{i}/{total}] ⚠️ Error scraping card: {e}")
+        return None
 
-        museums.append(museum_data)
 
-        # --- Save progress live ---
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(museums, f, ensure_ascii=False, indent=2)
+async def gather_all(tasks):
+    semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+    # HTTP/2 multiplexes all requests over one TLS connection; httpx already
+    # advertises every content encoding it can decode (gzip, plus br if brotli
+    # is installed).
+    limits = httpx.Limits(max_connections=16, max_keepalive_connections=16)
+    cache = open_page_cache()
+    try:
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=REQUEST_TIMEOUT_SECONDS,
+                                     follow_redirects=True,
+                                     headers={"User-Agent": USER_AGENT}) as client:
+            results = await asyncio.gather(*(
+                scrape_detail(client, semaphore, cache, i, len(tasks), link, thumbnail)
+                for i, (link, thumbnail) in enumerate(tasks, start=1)
+            ))
+    finally:
+        cache.close()
+    return [m for m in results if m is not None]
 
-        print(f"[{i}/{len(cards)}] ✅ {name} — {location}")
 
-    except Exception as e:
-        print(f"[{i}/{len(cards)}] ⚠️ Error scraping card: {e}")
+def absolute_link(href):
+    return "https://www.museum.nl" + href if href.startswith("/") else href
+
+
+def collect_cards_http():
+    """Page through the listing with plain HTTP via its mv-PageIndex parameter.
+
+    Returns [] when the listing has no server-rendered cards, or when paging
+    stops while the page still offers 'Laad meer' (the parameter was ignored),
+    so the caller can fall back to the browser.
+    """
+    tasks = []
+    seen_links = set()
+    with requests.Session() as session:
+        session.headers.update({"User-Agent": USER_AGENT})
+        for page in itertools.count():
+            res = session.get(LISTING_URL, params={"mv-PageIndex": page}, timeout=REQUEST_TIMEOUT_SECONDS)
+            res.raise_for_status()
+            soup = BeautifulSoup(res.text, "lxml")
+
+            new = 0
+            for card in soup.select(CARD_SELECTOR):
+                link_elem = card.select_one("a[href]")
+                if link_elem is None:
+                    continue
+                link = absolute_link(link_elem["href"])
+                if link in seen_links:
+                    continue
+                seen_links.add(link)
+                img_elem = card.select_one("img")
+                src = img_elem.get("src") if img_elem else None
+                tasks.append((link, urljoin(res.url, src) if src else None))
+                new += 1
+
+            if not new:
+                if soup.select_one(LOAD_MORE_SELECTOR):
+                    print(f"⚠️ Page {page} added no museums but still shows 'Laad meer'; "
+                          "mv-PageIndex paging does not work over plain HTTP.")
+                    return []
+                break
+            print(f"🔄 Page {page}: {new} museums")
+    return tasks
+
+
+def collect_cards_selenium():
+    """Render the listing in headless Chrome and click 'Laad meer' until done."""
+    options = Options()
+    options.add_argument("--headless")          # run browser in background
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+
+    driver = webdriver.Chrome(
+        service=Service(ChromeDriverManager().install()),
+        options=options
+    )
+
+    # Always release the browser, even if the page never renders
+    try:
+        # --- Open page ---
+        driver.get(f"{LISTING_URL}?mv-PageIndex=0")
+        wait = WebDriverWait(driver, PAGE_WAIT_SECONDS)
+        try:
+            wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, CARD_SELECTOR)))
+            print("🌐 Page loaded, starting to click 'Laad meer'...")
+        except TimeoutException:
+            print(f"⚠️ No museum cards rendered within {PAGE_WAIT_SECONDS}s, trying anyway...")
+
+        # --- Keep clicking "Laad meer" until it's gone ---
+        timeouts = 0
+        while True:
+            try:
+                load_more = driver.find_element(By.CSS_SELECTOR, LOAD_MORE_SELECTOR)
+                prev_count = len(driver.find_elements(By.CSS_SELECTOR, CARD_SELECTOR))
+                driver.execute_script("arguments[0].scrollIntoView(true);", load_more)
+                driver.execute_script("arguments[0].click();", load_more)
+                print("🔄 Loading more museums...")
+                # Wait only until the new cards have rendered
+                wait.until(lambda d: len(d.find_elements(By.CSS_SELECTOR, CARD_SELECTOR)) > prev_count)
+                timeouts = 0
+            except NoSuchElementException:
+                print("✅ No more museums to load.")
+                break
+            except TimeoutException:
+                if not driver.find_elements(By.CSS_SELECTOR, LOAD_MORE_SELECTOR):
+                    print("✅ No more museums to load.")
+                    break
+                timeouts += 1
+                if timeouts >= LOAD_MORE_RETRIES:
+                    print(f"⚠️ 'Laad meer' still showing but added no museums after {timeouts} tries, "
+                          "stopping with a partial listing.")
+                    break
+                print("⚠️ 'Laad meer' is slow to respond, retrying...")
+                continue
+            except ElementClickInterceptedException:
+                print("⚠️ Could not click 'Laad meer' this round, retrying...")
+                time.sleep(2)
+                continue
+
+        # --- Collect (link, thumbnail) pairs from the rendered cards in one call ---
+        pairs = driver.execute_script(
+            "return Array.from(document.querySelectorAll(arguments[0])).map(c => ({"
+            "href: c.querySelector('a')?.href ?? null,"
+            "img: c.querySelector('img')?.src ?? null}));",
+            CARD_SELECTOR
+        )
+    finally:
+        # --- Browser is no longer needed; free it before the network-bound phase ---
+        driver.quit()
+
+    tasks = []
+    for i, pair in enumerate(pairs, start=1):
+        # Keys holding `undefined` may be dropped by the driver
+        if not pair.get("href"):
+            print(f"[{i}/{len(pairs)}] ⚠️ Error reading card: no link")
+            continue
+        tasks.append((absolute_link(pair["href"]), pair.get("img")))
+    return tasks
+
+
+# --- Collect museum cards, preferring plain HTTP over the browser ---
+try:
+    cards = collect_cards_http()
+except requests.RequestException as e:
+    print(f"⚠️ HTTP listing failed: {e}")
+    cards = []
+if not cards:
+    print("🌐 HTTP listing empty or incomplete, falling back to Selenium...")
+    cards = collect_cards_selenium()
+
+museums = []
+output_file = "museums.json"
+
+# If file exists (resuming), load existing progress
+if os.path.exists(output_file):
+    with open(output_file, "rb") as f:
+        try:
+            museums = orjson.loads(f.read())
+        except orjson.JSONDecodeError:
+            museums = []
+
+# Links already scraped in a previous run are skipped below
+seen = {m["link"] for m in museums}
+
+print(f"🔍 Found {len(cards)} museum cards.")
+
+tasks = []
+for link, thumbnail in cards:
+    if link in seen:
+        continue
+    seen.add(link)
+    tasks.append((link, thumbnail))
+
+print(f"⏭️ {len(cards) - len(tasks)} cards already scraped, {len(tasks)} to fetch.")
+
+# --- Fetch and parse detail pages concurrently ---
+museums.extend(asyncio.run(gather_all(tasks)))
 
-driver.quit()
+with open(output_file, "wb") as f:
+    f.write(orjson.dumps(museums, option=orjson.OPT_INDENT_2))
 
 print(f"\n🎉 Done! Saved {len(museums)} museums to {output_file}")